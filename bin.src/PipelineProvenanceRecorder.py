@@ -23,42 +23,45 @@
 #
 
 import os.path
-import optparse
+import argparse
 
-from builtins import range
 
-import lsst.ctrl.provenance.dc3 as dc3
-from lsst.ctrl.provenance.ProvenanceSetup import ProvenanceSetup
-from lsst.pex.logging import Log
+def main():
+    parser = argparse.ArgumentParser()
 
-usage = "usage: %prog --runid=<runid> --activityname=<actvityname> --platform=<platform> --dbrun=<dbrun> " \
-        "--dbglobal=<dbglobal> --activoffset=<activoffset> --runoffset=<runoffset> [policyfile]+"
-parser = optparse.OptionParser(usage)
+    parser.add_argument("-r", "--runid", action="store", dest="runid", default=None)
+    parser.add_argument("-a", "--activityname", action="store", dest="activityname", default=None)
+    parser.add_argument("-p", "--platform", action="store", dest="platform", default=None)
+    parser.add_argument("-R", "--dbrun", action="store", dest="dbrun", default=None)
+    parser.add_argument("-G", "--dbglobal", action="store", dest="dbglobal", default=None)
+    parser.add_argument("-v", "--activoffset", type=int, action="store", dest="activoffset", default=0)
+    parser.add_argument("-o", "--runoffset", type=int, action="store", dest="runoffset", default=0)
+    parser.add_argument("-w", "--localrepos", action="store", dest="localrepos", default=None)
+    parser.add_argument("policyfiles", nargs="*")
 
-parser.add_option("-r", "--runid", action="store", dest="runid", default=None)
-parser.add_option("-a", "--activityname", action="store", dest="activityname", default=None)
-parser.add_option("-p", "--platform", action="store", dest="platform", default=None)
-parser.add_option("-R", "--dbrun", action="store", dest="dbrun", default=None)
-parser.add_option("-G", "--dbglobal", action="store", dest="dbglobal", default=None)
-parser.add_option("-v", "--activoffset", type="int", action="store", dest="activoffset", default=0)
-parser.add_option("-o", "--runoffset", type="int", action="store", dest="runoffset", default=0)
-parser.add_option("-w", "--localrepos", action="store", dest="localrepos", default=None)
+    opts = parser.parse_args()
 
-parser.opts = {}
-parser.args = []
+    # the stack imports are deliberately deferred until after argument
+    # parsing so that --help and usage errors return without paying the
+    # (substantial) import cost
+    import lsst.ctrl.provenance.dc3 as dc3
+    from lsst.ctrl.provenance.ProvenanceSetup import ProvenanceSetup
+    from lsst.pex.logging import Log
 
-(parser.opts, parser.args) = parser.parse_args()
+    logger = Log(Log.getDefaultLog(), "PipelineProvenanceRecorder")
 
-logger = Log(Log.getDefaultLog(), "PipelineProvenanceRecorder")
+    recorder = dc3.Recorder(opts.runid, opts.activityname, opts.platform,
+                            opts.dbrun, opts.dbglobal, opts.activoffset,
+                            opts.runoffset, logger)
 
-recorder = dc3.Recorder(parser.opts.runid, parser.opts.activityname, parser.opts.platform,
-                        parser.opts.dbrun, parser.opts.dbglobal, parser.opts.activoffset,
-                        parser.opts.runoffset, logger)
+    provSetup = ProvenanceSetup()
+    provSetup.addProductionRecorder(recorder)
 
-provSetup = ProvenanceSetup()
-provSetup.addProductionRecorder(recorder)
+    join = os.path.join
+    provSetup.addProductionPolicyFiles([join(opts.localrepos, f)
+                                        for f in opts.policyfiles])
+    provSetup.recordProduction()
 
-for i in range(len(parser.args)):
-    filename = os.path.join(parser.opts.localrepos, parser.args[i])
-    provSetup.addProductionPolicyFile(filename)
-provSetup.recordProduction()
+
+if __name__ == "__main__":
+    main()
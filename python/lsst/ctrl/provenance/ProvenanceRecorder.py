@@ -33,6 +33,10 @@ class ProvenanceRecorder(object):
     provenance store.
     """
 
+    # no per-instance __dict__; subclasses that need ad-hoc attributes
+    # get one of their own automatically by not defining __slots__
+    __slots__ = ('_logger',)
+
     def __init__(self, logger=None, fromSub=False):
         """
         As this class is abstract, it should only be executed from a
@@ -62,11 +66,34 @@ class ProvenanceRecorder(object):
         self._logger.log(Log.DEBUG,
                          "no implementation for recording environment")
 
-    def record(self, filename):
+    def record(self, filename, policy=None):
         """
         send the contents of the given file to the provenance store.
+        @param filename   the path to the file to record
+        @param policy     an optional pre-parsed Policy for the file;
+                            subclasses that would otherwise parse the
+                            file themselves should use it when given
+                            rather than parsing the file a second time.
         """
         msg = 'called "abstract" Provenance.record'
         if self._logger:
             self._logger.log(Log.FATAL, msg)
         raise RuntimeError(msg)
+
+    def recordAll(self, filenames, policies=None):
+        """
+        send the contents of all of the given files to the provenance
+        store.  The default implementation simply calls record() on
+        each file in turn with the filename alone, so subclasses with
+        the older one-argument record() signature keep working;
+        subclasses that can talk to their store more efficiently in
+        bulk (e.g. via a single batched database transaction) or that
+        want to consume the pre-parsed policies should override this.
+        @param filenames   a list of paths to the files to record
+        @param policies    an optional parallel list of pre-parsed
+                             Policy instances (or None entries) for the
+                             files, ignored by this default
+                             implementation.
+        """
+        for filename in filenames:
+            self.record(filename)
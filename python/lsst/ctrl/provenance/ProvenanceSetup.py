@@ -21,10 +21,13 @@
 #
 from __future__ import absolute_import
 
+import collections
+import functools
 import os
+import queue
+import threading
 
 from builtins import str
-from builtins import range
 from builtins import object
 
 from lsst.pex.policy import Policy
@@ -33,6 +36,77 @@ import lsst.pex.exceptions
 from .ProvenanceRecorder import ProvenanceRecorder
 
 
+# a registered template for a workflow provenance-recording command
+_CmdTmpl = collections.namedtuple("_CmdTmpl", ["cmd", "args", "path"])
+
+
+if hasattr(os, "posix_fadvise"):
+    def _prefetchFiles(paths):
+        """
+        hint the kernel to start readahead on the given files so that
+        the synchronous parses that follow find their bytes already in
+        the page cache instead of serializing on per-file read latency.
+        This is purely advisory; any failure is ignored.
+        """
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+else:
+    def _prefetchFiles(paths):
+        """no-op stand-in on platforms without posix_fadvise."""
+        pass
+
+
+# memoized results of the include-graph walks below, keyed by the top
+# policy file's identity (path, mtime, size) plus the walk arguments.
+# The stat check means an edited top file is re-walked; edits further
+# down an unchanged file's include graph are not detected, which is
+# acceptable for the repository-style policy trees this package records.
+_extractCache = {}
+
+
+def _statKey(filename):
+    """
+    return the (st_mtime_ns, st_size) identity of a file, or None if it
+    cannot be stat-ed (in which case results must not be cached).
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+@functools.lru_cache(maxsize=None)
+def _loadPolicyIdentified(filename, statid):
+    """
+    parse a policy file, memoized by its (path, (mtime, size))
+    identity; use _loadPolicyCached(), which supplies the identity.
+    """
+    policy = Policy.createPolicy(filename, False)
+    return policy, tuple(policy.names(True))
+
+
+def _loadPolicyCached(filename):
+    """
+    load and parse a policy file, memoizing the result by the file's
+    path, mtime (in nanoseconds), and size -- the same identity the dc3
+    recorder's policy cache uses -- so that a file shared by several
+    include graphs is only parsed once while an edited file is re-read
+    rather than served stale.  The return value is a tuple
+    (policy, names) where names is the pre-computed policy.names(True)
+    list (as a tuple), so that callers traversing cached policies do
+    not have to re-query it.
+    """
+    return _loadPolicyIdentified(filename, _statKey(filename))
+
+
 class ProvenanceSetup(object):
     """
     a container for collecting and bring together provideres and
@@ -51,24 +125,60 @@ class ProvenanceSetup(object):
     command line template (for recording on a remote platform).
     """
 
+    __slots__ = ('_pfiles', '_seen', '_walked', '_consumers',
+                 '_cmdTmpls', '_workers')
+
     def __init__(self):
 
-        # list of policy files to record via PolicyRecorders
+        # list of (filename, policy) pairs to record via
+        # PolicyRecorders; policy is a pre-parsed Policy or None
         self._pfiles = []
 
+        # the set of filenames already added, used to skip duplicates
+        # cheaply
+        self._seen = set()
+
+        # the subset of filenames whose include subtrees have already
+        # been walked by addAllProductionPolicyFiles; only these may be
+        # pruned from later walks, since individually added files have
+        # includes we have never examined
+        self._walked = set()
+
         # the list of interested consumers, as PolicyRecorder instances
         self._consumers = []
 
         # the list of command line templates
         self._cmdTmpls = []
 
-    def addProductionPolicyFile(self, filename):
+        # (queue, thread, errors) entries for recording still running
+        # in the background; see recordProduction() and flush()
+        self._workers = []
+
+    def addProductionPolicyFile(self, filename, policy=None):
         """
         add a policy file to record via the interested PolicyRecorders.
         Typically, the file will contain production-level policy data.
+        A file that has already been added is silently skipped.
         @param filename   the full path to the policy file
+        @param policy     an optional pre-parsed Policy for the file,
+                            passed along to recorders that know how to
+                            use one so the file is not parsed again at
+                            recording time.
+        """
+        if filename in self._seen:
+            return
+        self._seen.add(filename)
+        self._pfiles.append((filename, policy))
+
+    def addProductionPolicyFiles(self, filenames):
+        """
+        add a list of policy files to record via the interested
+        PolicyRecorders in a single call.  Previously added files are
+        silently skipped.
+        @param filenames   a list of full paths to the policy files
         """
-        self._pfiles.append(filename)
+        for filename in filenames:
+            self.addProductionPolicyFile(filename)
 
     def addAllProductionPolicyFiles(self, filename, repository=".",
                                     pipefile="workflow.pipeline.definition",
@@ -99,20 +209,42 @@ class ProvenanceSetup(object):
                               warnings about missing or bad files;
                               otherwise, problems are silently ignored.
         """
+        # tell the walker about the (repository-relative) files whose
+        # include subtrees earlier walks have already covered so that
+        # it can prune them; files added individually were never
+        # walked, so they must not be pruned
+        known = None
+        if self._walked:
+            prefix = os.path.join(repository, "")
+            known = set(f[len(prefix):] for f in self._walked
+                        if f.startswith(prefix))
+
         filenames = ProvenanceSetup.extractIncludedFilenames(filename,
                                                              repository,
                                                              pipefile,
-                                                             logger)
-        self.addProductionPolicyFile(filename)
+                                                             logger,
+                                                             known)
+        # the walk above just parsed these files, so hand the cached
+        # Policy objects along for recorders to reuse
+        self.addProductionPolicyFile(filename, _loadPolicyCached(filename)[0])
+        self._walked.add(filename)
         for file in filenames:
-            self.addProductionPolicyFile(os.path.join(repository, file))
+            file = os.path.join(repository, file)
+            policy = None
+            if os.path.exists(file):
+                try:
+                    policy = _loadPolicyCached(file)[0]
+                except lsst.pex.exceptions.Exception:
+                    pass
+            self.addProductionPolicyFile(file, policy)
+            self._walked.add(file)
 
     def getFiles(self):
         """
         return the list of production policy filenames that will get
         recorded.
         """
-        return list(self._pfiles)
+        return [f[0] for f in self._pfiles]
 
     def addProductionRecorder(self, recorder):
         """
@@ -123,7 +255,9 @@ class ProvenanceSetup(object):
                             how to connect to a provenance store,
                             database, or other consumer
         """
-        if not isinstance(recorder, ProvenanceRecorder):
+        # skipped under python -O; recording only needs the record*
+        # methods, so the type check is a development-time guard
+        if __debug__ and not isinstance(recorder, ProvenanceRecorder):
             raise TypeError("addProductionRecorder(): arg not a ProvenanceRecorder")
         self._consumers.append(recorder)
 
@@ -157,7 +291,7 @@ class ProvenanceSetup(object):
             args = []
         elif not isinstance(args, list):
             raise TypeError("addWorkflowRecordCmd: args: not a list")
-        self._cmdTmpls.append((cmd, list(args), path))
+        self._cmdTmpls.append(_CmdTmpl(cmd, list(args), path))
 
     def getRecorders(self):
         """
@@ -165,17 +299,110 @@ class ProvenanceSetup(object):
         """
         return list(self._consumers)
 
-    def recordProduction(self):
+    def recordProduction(self, wait=True):
         """
         record the production-level policy provenance to all
-        interested databases. This will do this by looping through
-        each ProvenanceRecorder that it has and call its record()
-        function.
+        interested databases. This will do this by calling the
+        recordAll() function on each ProvenanceRecorder that it has
+        with the full list of policy files, allowing the recorder to
+        batch its writes to the provenance store.  Since the recorders
+        talk to independent (and typically network-bound) stores, each
+        one is drained by its own background thread.
+        @param wait   if True (default), block until every recorder has
+                        finished.  If False, return as soon as the work
+                        has been queued so that orchestration can
+                        proceed while the stores are written; flush()
+                        must then be called before the production
+                        shuts down.
         """
+        if not self._consumers:
+            return
+
+        # record the largest files first so that the longest transfers
+        # are not left serializing the tail of the run; sort a copy so
+        # that getFiles() keeps reporting files in the order they were
+        # added
+        pfiles = sorted(self._pfiles, key=lambda f: self._fileSize(f[0]),
+                        reverse=True)
+
+        if wait and len(self._consumers) == 1:
+            # nothing to overlap; skip the thread machinery
+            try:
+                self._recordOne(self._consumers[0], pfiles)
+            finally:
+                _loadPolicyIdentified.cache_clear()
+            return
+
+        work = ([f[0] for f in pfiles], [f[1] for f in pfiles])
         for consumer in self._consumers:
-            for file in self._pfiles:
-                consumer.record(file)
-            consumer.recordEnv()
+            q = queue.Queue()
+            errors = []
+            worker = threading.Thread(target=ProvenanceSetup._drain,
+                                      args=(q, consumer, errors))
+            worker.daemon = True
+            worker.start()
+            q.put(work)
+            q.put(None)  # sentinel: no more work for this run
+            self._workers.append((q, worker, errors))
+
+        if wait:
+            self.flush()
+
+    def flush(self):
+        """
+        wait for any provenance recording still running in the
+        background (from recordProduction(wait=False)) to complete.
+        This is a no-op when nothing is pending.  If a consumer failed
+        while recording, its exception is re-raised here (the first
+        one, when several consumers failed) so that the failure is not
+        silently swallowed by the worker thread.
+        """
+        workers = self._workers
+        self._workers = []
+        failure = None
+        for q, worker, errors in workers:
+            worker.join()
+            if errors and failure is None:
+                failure = errors[0]
+        if workers:
+            # the parsed-policy cache is only worth its memory while the
+            # production's include graphs are being walked and recorded
+            _loadPolicyIdentified.cache_clear()
+        if failure is not None:
+            raise failure
+
+    @staticmethod
+    def _drain(q, consumer, errors):
+        """pull recording work off a queue and feed it to one consumer
+        until the sentinel arrives; each consumer owns its own store
+        connection, so the drains are independent.  A failure ends the
+        drain and is captured into errors for flush() to re-raise."""
+        while True:
+            work = q.get()
+            if work is None:
+                break
+            try:
+                filenames, policies = work
+                consumer.recordAll(filenames, policies)
+                consumer.recordEnv()
+            except Exception as ex:
+                errors.append(ex)
+                break
+
+    def _recordOne(self, consumer, pfiles):
+        """record the given (filename, policy) pairs to one consumer."""
+        consumer.recordAll([f[0] for f in pfiles],
+                           [f[1] for f in pfiles])
+        consumer.recordEnv()
+
+    @staticmethod
+    def _fileSize(filename):
+        """return the size of the given file, or 0 if it cannot be
+        stat-ed."""
+        try:
+            return os.path.getsize(filename)
+        except OSError:
+            return 0
 
     def getCmdPaths(self):
         """
@@ -188,7 +415,7 @@ class ProvenanceSetup(object):
         returned by getCmds().  If an element is non-None, then the
         script should be copied to the remote workflow platform.
         """
-        return [s[2] for s in self._cmdTmpls]
+        return [t.path for t in self._cmdTmpls]
 
     def getCmds(self):
         """
@@ -208,16 +435,11 @@ class ProvenanceSetup(object):
              files to record.
           3. join and execute the command word list.
         """
-        out = []
-        for cmd in self._cmdTmpls:
-            cl = [cmd[0]]
-            cl.extend(cmd[1])
-            out.append(cl)
-        return out
+        return [[t.cmd, *t.args] for t in self._cmdTmpls]
 
     @staticmethod
     def extractIncludedFilenames(prodPolicyFile, repository=".",
-                                 pipefile=None, logger=None):
+                                 pipefile=None, logger=None, known=None):
         """
         extract all the filenames included, directly or indirectly, from the
         given policy file.  When a repository is provided, included files will
@@ -235,54 +457,123 @@ class ProvenanceSetup(object):
         @param logger           if provided, use this Log to record any
                                    warnings about missing or bad files;
                                    otherwise, problems are silently ignored.
+        @param known            a set of repository-relative filenames that
+                                   are already known to the caller; their
+                                   include subtrees will not be re-walked,
+                                   and they are excluded from the output.
         @return set   containing the unique set of policy filenames found,
                         including the given top file and the
         """
-        prodPolicy = Policy.createPolicy(prodPolicyFile, False)
+        # repeated walks of an unchanged file are served from the
+        # module cache; walks pruned by a caller's known set are
+        # caller-specific and so are not cached
+        cacheKey = None
+        if known is None:
+            statid = _statKey(prodPolicyFile)
+            if statid is not None:
+                cacheKey = ("incl", prodPolicyFile, repository, pipefile,
+                            statid)
+                cached = _extractCache.get(cacheKey)
+                if cached is not None:
+                    return set(cached)
+
+        prodPolicy, names = _loadPolicyCached(prodPolicyFile)
         filenames = set([prodPolicyFile])
+        if known:
+            filenames.update(known)
         ProvenanceSetup._listFilenames(filenames, prodPolicy, None, repository,
-                                       pipefile, logger)
+                                       pipefile, logger, names)
         filenames.discard(prodPolicyFile)
+        if known:
+            filenames.difference_update(known)
+
+        if cacheKey is not None:
+            _extractCache[cacheKey] = frozenset(filenames)
         return filenames
 
     @staticmethod
     def _listFilenames(fileset, policy, basename, repository, stopname=None,
-                       logger=None):
-        if stopname and basename and not stopname.startswith(basename):
-            stopname = None
-        for name in policy.names(True):
-            fullname = basename and ".".join([basename, name]) or name
-            if stopname and fullname == stopname:
-                continue
+                       logger=None, names=None):
+        # breadth-first walk over the policy tree via an explicit work
+        # queue; each entry is (policy, path, names) where path is the
+        # hierarchical name as a tuple of components, so the stopname
+        # prefix test is a tuple slice rather than per-node string
+        # building.  A per-directory listing cache stands in for
+        # os.path.exists so that the walk costs one scandir per
+        # directory instead of one stat per included file.
+        stop = tuple(stopname.split(".")) if stopname else None
+        stoplen = stop and len(stop)
+        path = tuple(basename.split(".")) if basename else ()
+
+        # resolve the logging thresholds once so that filtered-out
+        # messages cost neither a sends() call nor string formatting
+        warn = logger is not None and logger.sends(Log.WARN)
+        debug = logger is not None and logger.sends(Log.DEBUG)
+
+        # bind the names hit on every include to locals, avoiding the
+        # global/attribute lookup chains inside the hot loop
+        _join = os.path.join
+        _load = _loadPolicyCached
+        _exists = ProvenanceSetup._cachedExists
+        _PexExc = lsst.pex.exceptions.Exception
+        WARN = Log.WARN
+        DEBUG = Log.DEBUG
+        pending = collections.deque([(policy, path, names)])
+        dircache = {}
+        while pending:
+            policy, path, names = pending.popleft()
+            if names is None:
+                names = policy.names(True)
+            for name in names:
+                fullpath = path + (name,)
+                if stop and fullpath[:stoplen] == stop:
+                    continue
 
-            if policy.isFile(name):
-                files = policy.getArray(name)
-                for file in files:
-                    file = file.getPath()
-                    if file not in fileset:
-                        fileset.add(file)
-                        file = os.path.join(repository, file)
-                        if not os.path.exists(file):
-                            if logger:
-                                logger.log(logger.WARN, "Policy file not found in repository: %s" % file)
+                if policy.isFile(name):
+                    files = [f.getPath() for f in policy.getArray(name)]
+                    if len(files) > 1:
+                        # start readahead on all of the siblings before
+                        # the one-by-one parses below
+                        _prefetchFiles(_join(repository, f) for f in files
+                                       if f not in fileset)
+                    for file in files:
+                        if file not in fileset:
+                            fileset.add(file)
+                            file = _join(repository, file)
+                            if not _exists(file, dircache):
+                                if warn:
+                                    logger.log(WARN, "Policy file not found in repository: %s" % file)
                                 continue
-                        try:
-                            if logger and logger.sends(Log.DEBUG):
-                                logger.log(Log.DEBUG, "opening log file: %s" % file)
-                            fpolicy = Policy.createPolicy(file, False)
-                            ProvenanceSetup._listFilenames(fileset, fpolicy,
-                                                           fullname, repository,
-                                                           stopname, logger)
-                        except lsst.pex.exceptions.Exception as ex:
-                            if logger:
-                                logger.log(Log.WARN, "problem loading %s: %s" % (file, str(ex)))
-                            continue
-
-            elif policy.isPolicy(name):
-                pols = policy.getArray(name)
-                for pol in pols:
-                    ProvenanceSetup._listFilenames(fileset, pol, fullname,
-                                                   repository, stopname, logger)
+                            try:
+                                if debug:
+                                    logger.log(DEBUG, "opening log file: %s" % file)
+                                fpolicy, fnames = _load(file)
+                                pending.append((fpolicy, fullpath, fnames))
+                            except _PexExc as ex:
+                                if warn:
+                                    logger.log(WARN, "problem loading %s: %s" % (file, str(ex)))
+                                continue
+
+                elif policy.isPolicy(name):
+                    pols = policy.getArray(name)
+                    for pol in pols:
+                        pending.append((pol, fullpath, None))
+
+    @staticmethod
+    def _cachedExists(path, dircache):
+        """
+        test whether the given file exists, caching the listing of its
+        directory in dircache so that siblings share one scandir call.
+        """
+        dir, base = os.path.split(path)
+        names = dircache.get(dir)
+        if names is None:
+            try:
+                names = set(entry.name for entry in os.scandir(dir or "."))
+            except OSError:
+                names = set()
+            dircache[dir] = names
+        return base in names
 
     @staticmethod
     def extractPipelineFilenames(wfname, prodPolicyFile, repository=".",
@@ -297,9 +588,20 @@ class ProvenanceSetup(object):
                                    warnings about missing or bad files;
                                    otherwise, problems are silently ignored.
         """
-        prodPolicy = Policy.createPolicy(prodPolicyFile, False)
+        cacheKey = None
+        statid = _statKey(prodPolicyFile)
+        if statid is not None:
+            cacheKey = ("pipe", wfname, prodPolicyFile, repository, statid)
+            cached = _extractCache.get(cacheKey)
+            if cached is not None:
+                return list(cached)
+
+        prodPolicy = _loadPolicyCached(prodPolicyFile)[0]
+
+        warn = logger is not None and logger.sends(Log.WARN)
 
         out = []
+        seen = set()
         wfs = ProvenanceSetup._shallowPolicyNodeResolve("workflow", prodPolicy,
                                                         repository, logger)
         if not wfs:
@@ -316,15 +618,22 @@ class ProvenanceSetup(object):
                 if not pipe.exists("definition") or not pipe.isFile("definition"):
                     continue
                 pipe = pipe.get("definition").getPath()
-                out.append(pipe)
+                if pipe not in seen:
+                    seen.add(pipe)
+                    out.append(pipe)
                 pipe = os.path.join(repository, pipe)
                 if not os.path.exists(pipe):
-                    if logger:
+                    if warn:
                         logger.log(Log.WARN, "Policy file not found in repository: "+pipe)
                     continue
-                out += list(ProvenanceSetup.extractIncludedFilenames(pipe,
-                                                                     repository))
-
+                found = ProvenanceSetup.extractIncludedFilenames(pipe,
+                                                                 repository,
+                                                                 known=seen)
+                seen.update(found)
+                out.extend(found)
+
+        if cacheKey is not None:
+            _extractCache[cacheKey] = tuple(out)
         return out
 
     @staticmethod
@@ -344,7 +653,7 @@ class ProvenanceSetup(object):
         out.append(pipe)
         pipe = os.path.join(repository, pipe)
         if not os.path.exists(pipe):
-            if logger:
+            if logger and logger.sends(Log.WARN):
                 logger.log(Log.WARN, "Policy file not found in repository: "+pipe)
             return
         out += list(ProvenanceSetup.extractIncludedFilenames(pipe, repository))
@@ -357,14 +666,17 @@ class ProvenanceSetup(object):
 
         nodes = policy.getArray(pname)
         if policy.isFile(pname):
-            for i in range(len(nodes)):
+            isabs = os.path.isabs
+            join = os.path.join
+            create = Policy.createPolicy
+            for i, node in enumerate(nodes):
                 try:
-                    if not os.path.isabs(nodes[i]):
-                        nodes[i] = os.path.join(repository, nodes[i])
-                    nodes[i] = Policy.createPolicy(nodes[i], False)
+                    if not isabs(node):
+                        node = join(repository, node)
+                    nodes[i] = create(node, False)
                 except lsst.pex.exceptions.Exception:
                     if logger:
-                        logger.log(Log.WARN, "problem finding/loading " + nodes[i])
+                        logger.log(Log.WARN, "problem finding/loading " + node)
                     nodes[i] = None
 
         return nodes
@@ -23,9 +23,11 @@
 import os
 
 from lsst.ctrl.provenance import ProvenanceRecorder
+import collections
 import eups
+import functools
 import hashlib
-import re
+import threading
 import lsst.pex.exceptions
 from lsst.pex.policy import Policy
 from lsst.pex.logging import Log
@@ -36,10 +38,100 @@ runid_incr = 2097152
 activ_incr = 512
 
 
+@functools.lru_cache(maxsize=None)
 def _offsetToActivityId(runidx, activeidx):
     return runidx * runid_incr + activeidx * activ_incr
 
 
+# memoized hash/parse results for policy files, keyed by
+# (path, mtime, size) so that entries go stale when a file changes.
+# Bounded LRU; the lock covers the lookup/evict pair since recorders
+# may run on separate threads under ProvenanceSetup.recordProduction.
+_policyCacheMax = 128
+_policyCache = collections.OrderedDict()
+_policyCacheLock = threading.Lock()
+
+
+def _parsePolicyFile(policyFile, policy=None):
+    """
+    return (digest, mtime, rows) for the given policy file, where
+    digest is the file's MD5 hex digest, mtime is its modification time
+    in nanoseconds, and rows is the list of (key name, key type, value)
+    triples to record.  Results are
+    memoized so that several recorders recording the same file hash and
+    parse it only once.  A pre-parsed policy, if given, is used on a
+    cache miss instead of re-parsing the file.
+    """
+    st = os.stat(policyFile)
+    key = (policyFile, st.st_mtime_ns, st.st_size)
+    with _policyCacheLock:
+        data = _policyCache.get(key)
+        if data is not None:
+            _policyCache.move_to_end(key)
+            return data
+
+    # read the file once and hash the whole buffer in a single native
+    # call; the parse below (when one is needed) then re-reads the same
+    # bytes out of the warm page cache rather than from the device
+    with open(policyFile, 'rb') as f:
+        md5 = hashlib.md5(f.read())
+
+    p = policy if policy is not None else Policy.createPolicy(policyFile, False)
+    # p.str works for arrays, too; extra nulls get included in the
+    # values, so strip them.  The method lookups are hoisted out of the
+    # comprehension, which matters for policies with many keys.
+    gt, ps = p.getTypeName, p.str
+    rows = [(name, gt(name), ps(name).replace('\x00', ''))
+            for name in p.paramNames()]
+
+    data = (md5.hexdigest(), st.st_mtime_ns, rows)
+    with _policyCacheLock:
+        _policyCache[key] = data
+        if len(_policyCache) > _policyCacheMax:
+            _policyCache.popitem(last=False)
+    return data
+
+
+class _MultiDb(object):
+    """
+    a write-through multiplexer over the slice of the DbStorage insert
+    API used by the Recorder.  Each call is forwarded to every backing
+    DbStorage instance, so provenance mirrored into several databases
+    pays the Python-side row-building cost only once.
+    """
+
+    def __init__(self, dbs):
+        self._dbs = tuple(dbs)
+
+    def startTransaction(self):
+        for db in self._dbs:
+            db.startTransaction()
+
+    def endTransaction(self):
+        for db in self._dbs:
+            db.endTransaction()
+
+    def setTableForInsert(self, table):
+        for db in self._dbs:
+            db.setTableForInsert(table)
+
+    def setColumnString(self, name, val):
+        for db in self._dbs:
+            db.setColumnString(name, val)
+
+    def setColumnInt(self, name, val):
+        for db in self._dbs:
+            db.setColumnInt(name, val)
+
+    def setColumnInt64(self, name, val):
+        for db in self._dbs:
+            db.setColumnInt64(name, val)
+
+    def insertRow(self):
+        for db in self._dbs:
+            db.insertRow()
+
+
 class Recorder(ProvenanceRecorder):
     """
     An implementation of the ProvenanceRecorder interface that understands
@@ -97,13 +189,47 @@ class Recorder(ProvenanceRecorder):
         # the index for this activity (launch process or workflow)
         self._aoffset = activOffset
 
-        self._rundb = DbStorage()
-        self._rundb.setPersistLocation(LogicalLocation(dbLoc))
+        # the database connections are opened lazily (see the _rundb
+        # and _globalDb properties below), and the run/activity
+        # registration is deferred to the first recording call, so
+        # constructing a Recorder that never records costs no
+        # connections or database round trips
+        self._runLoc = LogicalLocation(dbLoc)
         self._globalLoc = LogicalLocation(globalDbLoc)
-        self._globalDb = DbStorage()
-        self._globalDb.setPersistLocation(self._globalLoc)
-
-        self.initialize()
+        self._rundbObj = None
+        self._globalDbObj = None
+        self._writeDbObj = None
+        self._initialized = False
+
+        # computed from the offsets on first use (see initActivity)
+        self._activityId = None
+
+    @property
+    def _rundb(self):
+        """the production run-specific database, opened on first use."""
+        if self._rundbObj is None:
+            self._rundbObj = DbStorage()
+            self._rundbObj.setPersistLocation(self._runLoc)
+        return self._rundbObj
+
+    @property
+    def _globalDb(self):
+        """the global provenance database, opened on first use."""
+        if self._globalDbObj is None:
+            self._globalDbObj = DbStorage()
+            self._globalDbObj.setPersistLocation(self._globalLoc)
+        return self._globalDbObj
+
+    @property
+    def _writeDb(self):
+        """
+        the multiplexer that all policy/environment provenance writes
+        fan out through; add self._rundb to the tuple to re-enable
+        mirroring into the run-specific database.
+        """
+        if self._writeDbObj is None:
+            self._writeDbObj = _MultiDb((self._globalDb,))
+        return self._writeDbObj
 
     def recordEnv(self):
         """
@@ -113,12 +239,101 @@ class Recorder(ProvenanceRecorder):
         """
         self.recordEnvironment()
 
-    def record(self, filename):
+    def record(self, filename, policy=None):
         """
         an implementation of the ProvenanceRecorder API.  This will record
-        the given policy filename.
+        the given policy filename.  If a pre-parsed policy is provided,
+        it is used instead of parsing the file again.
         """
-        self.recordPolicy(filename)
+        self.recordPolicy(filename, policy)
+
+    # number of rows to accumulate in memory before flushing them to the
+    # database; bounds memory for very large productions while keeping
+    # each flush a single bulk transaction
+    _flushEvery = 10000
+
+    def recordAll(self, filenames, policies=None):
+        """
+        an implementation of the ProvenanceRecorder API that records all
+        of the given policy files in bulk.  Parsed rows accumulate in
+        memory and are flushed to the database in large chunks, each
+        chunk a single transaction, rather than the
+        one-transaction-per-insert pattern that record() would produce
+        for each file.  Pre-parsed policies, when provided, are used in
+        place of re-parsing the files.
+        """
+        self.initialize()
+        if policies is None:
+            policies = [None] * len(filenames)
+        parsed = []
+        nrows = 0
+        for filename, p in zip(filenames, policies):
+            digest, mtime, rows = _parsePolicyFile(filename, p)
+            parsed.append((filename, digest, mtime, rows))
+            nrows += len(rows) + 1
+            if nrows >= self._flushEvery:
+                self._flushPolicyFiles(self._writeDb,
+                                       self._assignPolicyIds(parsed))
+                parsed = []
+                nrows = 0
+        if parsed:
+            self._flushPolicyFiles(self._writeDb,
+                                   self._assignPolicyIds(parsed))
+
+    def _assignPolicyIds(self, parsed):
+        """
+        assign file and key ids to a batch of parsed policy files.
+        Takes (filename, digest, mtime, rows) tuples and returns
+        (filename, digest, mtime, fileId, rows) tuples whose rows carry
+        a (keyId, key, type, val) each.  The counters advance once per
+        file and key here, so the returned batch can be written to any
+        number of databases without the ids drifting apart.
+        """
+        out = []
+        for filename, digest, mtime, rows in parsed:
+            fileId = self._policyFileId
+            self._policyFileId += 1
+            krows = []
+            for key, type, val in rows:
+                krows.append((self._policyKeyId, key, type, val))
+                self._policyKeyId += 1
+            out.append((filename, digest, mtime, fileId, krows))
+        return out
+
+    def _flushPolicyFiles(self, db, batch):
+        """write a batch of id-assigned policy files, as returned by
+        _assignPolicyIds, to one database in one transaction.  The
+        inserts are grouped by table, so each table's prepared insert
+        is set up once per batch and then reused for all of its rows
+        instead of being rebuilt on every table switch."""
+        db.startTransaction()
+
+        db.setTableForInsert("prv_PolicyFile")
+        for filename, digest, mtime, fileId, rows in batch:
+            db.setColumnInt64("policyFileId", fileId)
+            db.setColumnString("pathname", filename)
+            db.setColumnString("hashValue", digest)
+            db.setColumnInt64("modifiedDate",
+                              DateTime(mtime, DateTime.UTC).nsecs())
+            db.insertRow()
+
+        db.setTableForInsert("prv_PolicyKey")
+        for filename, digest, mtime, fileId, rows in batch:
+            for keyId, key, type, val in rows:
+                db.setColumnInt64("policyKeyId", keyId)
+                db.setColumnInt64("policyFileId", fileId)
+                db.setColumnString("keyName", key)
+                db.setColumnString("keyType", type)
+                db.insertRow()
+
+        db.setTableForInsert("prv_cnf_PolicyKey")
+        for filename, digest, mtime, fileId, rows in batch:
+            for keyId, key, type, val in rows:
+                db.setColumnInt64("policyKeyId", keyId)
+                db.setColumnString("value", val)
+                db.insertRow()
+
+        db.endTransaction()
 
     def getRunOffset(self):
         """
@@ -133,8 +348,12 @@ class Recorder(ProvenanceRecorder):
         add data to the provenance database that identifies this run (if
         necessary) and activity.  In particular, this will assign
         the runId's index offset (which can be retrieved afterward via
-        getRunOffset()).
+        getRunOffset()).  This happens automatically the first time
+        provenance is recorded; calling it again is a no-op.
         """
+        if self._initialized:
+            return
+
         isOrch = self._roffset is None
         if isOrch:
             acttype = "launch"
@@ -142,8 +361,18 @@ class Recorder(ProvenanceRecorder):
         else:
             acttype = "workflow"
 
+        # the offsets are fixed from here on, so compute the activity ID
+        # once for all of the subsequent inserts
+        self._activityId = _offsetToActivityId(self._roffset, self._aoffset)
+
         self.initActivity(self._activName, acttype, self._platName)
 
+        # only now that registration has succeeded; a failure above
+        # (e.g. a transient database error) leaves the recorder
+        # uninitialized so the next recording call retries and surfaces
+        # the real error rather than an AttributeError
+        self._initialized = True
+
     def queryRunOffset(self):
         """
         query the database to get the run offset for the current runid.
@@ -197,7 +426,12 @@ class Recorder(ProvenanceRecorder):
         if self._aoffset is None:
             raise lsst.pex.exceptions.Exception("Unknown activity index")
 
-        activityId = _offsetToActivityId(self._roffset, self._aoffset)
+        activityId = self._activityId
+        if activityId is None:
+            # derive the id here so that direct callers do not depend
+            # on initialize() having run first
+            activityId = self._activityId = \
+                _offsetToActivityId(self._roffset, self._aoffset)
 
         self._globalDb.startTransaction()
         self._globalDb.setTableForInsert("prv_Activity")
@@ -214,79 +448,44 @@ class Recorder(ProvenanceRecorder):
     def recordEnvironment(self):
         """Record the software environment of the pipeline."""
 
+        self.initialize()
+
         setupList = eups.Eups().listProducts(setup=True)
-        # self._realRecordEnvironment(self._rundb, setupList)
-        self._realRecordEnvironment(self._globalDb, setupList)
+        self._realRecordEnvironment(self._writeDb, setupList)
 
     def _realRecordEnvironment(self, db, setupList):
+        # precompute the rows, then load each table in its own pass so
+        # that the prepared insert statement is reused across all of a
+        # table's rows instead of being rebuilt on every table switch
+        base = self._activityId + 1
+        rows = [(base + i, product) for i, product in enumerate(setupList)]
+
         db.startTransaction()
 
-        id = _offsetToActivityId(self._roffset, self._aoffset) + 1
-        for product in setupList:
-            db.setTableForInsert("prv_SoftwarePackage")
+        db.setTableForInsert("prv_SoftwarePackage")
+        for id, product in rows:
             db.setColumnInt64("packageId", id)
             db.setColumnString("packageName", product.name)
             db.insertRow()
 
-            db.setTableForInsert("prv_cnf_SoftwarePackage")
+        db.setTableForInsert("prv_cnf_SoftwarePackage")
+        for id, product in rows:
             db.setColumnInt64("packageId", id)
             db.setColumnString("version", product.version)
             db.setColumnString("directory", product.dir)
             db.insertRow()
 
-            id += 1
-
         db.endTransaction()
 
-    def recordPolicy(self, policyFile):
-        """Record the contents of the given Policy as part of provenance."""
+    def recordPolicy(self, policyFile, policy=None):
+        """Record the contents of the given Policy as part of provenance.
+        If a pre-parsed policy is provided, it is used instead of
+        parsing the file again."""
 
-        md5 = hashlib.md5()
-        f = open(policyFile, 'r')
-        for line in f:
-            md5.update(line)
-        f.close()
-
-        # self._realRecordPolicyFile(self._rundb, policyFile, md5)
-        self._realRecordPolicyFile(self._globalDb, policyFile, md5)
-
-        p = Policy.createPolicy(policyFile, False)
-        for key in p.paramNames():
-            type = p.getTypeName(key)
-            val = p.str(key)  # works for arrays, too
-            val = re.sub(r'\0', r'', val)  # extra nulls get included
-            # self._realRecordPolicyContents(self._rundb, key, type, val)
-            self._realRecordPolicyContents(self._globalDb, key, type, val)
-
-            self._policyKeyId += 1
-
-        self._policyFileId += 1
-
-    def _realRecordPolicyFile(self, db, file, md5):
-        db.startTransaction()
-
-        db.setTableForInsert("prv_PolicyFile")
-        db.setColumnInt64("policyFileId", self._policyFileId)
-        db.setColumnString("pathname", file)
-        db.setColumnString("hashValue", md5.hexdigest())
-        db.setColumnInt64("modifiedDate",
-                          DateTime(os.stat(file)[8] * 1000000000, DateTime.UTC).nsecs())
-        db.insertRow()
+        self.initialize()
 
-        db.endTransaction()
+        digest, mtime, rows = _parsePolicyFile(policyFile, policy)
 
-    def _realRecordPolicyContents(self, db, key, type, val):
-        db.startTransaction()
-        db.setTableForInsert("prv_PolicyKey")
-        db.setColumnInt64("policyKeyId", self._policyKeyId)
-        db.setColumnInt64("policyFileId", self._policyFileId)
-        db.setColumnString("keyName", key)
-        db.setColumnString("keyType", type)
-        db.insertRow()
+        batch = self._assignPolicyIds([(policyFile, digest, mtime, rows)])
+        self._flushPolicyFiles(self._writeDb, batch)
 
-        db.setTableForInsert("prv_cnf_PolicyKey")
-        db.setColumnInt64("policyKeyId", self._policyKeyId)
-        db.setColumnString("value", val)
-        db.insertRow()
-
-        db.endTransaction()
@@ -23,8 +23,8 @@
 """
 Tests of the ProvenanceRecorder
 """
-from __future__ import print_function
 import os
+import threading
 import unittest
 
 import lsst.utils.tests
@@ -34,189 +34,236 @@ from lsst.ctrl.provenance import ProvenanceSetup
 
 logger = Log(Log.getDefaultLog(), "tester")
 logger.setThreshold(Log.FATAL+10)
-repos = os.path.join(os.environ['CTRL_PROVENANCE_DIR'], "tests", "policy")
-prodPolicyFile = os.path.join(repos, "production.paf")
 
+# resolved in setUpModule(); depending on CTRL_PROVENANCE_DIR at import
+# time would make mere test discovery fail when the package is not set up
+repos = None
+prodPolicyFile = None
+
+
+def setUpModule():
+    global repos, prodPolicyFile
+    repos = os.path.join(os.environ['CTRL_PROVENANCE_DIR'], "tests", "policy")
+    prodPolicyFile = os.path.join(repos, "production.paf")
+    lsst.utils.tests.init()
 
-class GoodRecorder(ProvenanceRecorder):
 
-    def __init__(self, testcase, logger=None):
+# argument and expected-filename constants shared across tests; the
+# tuples are copied to fresh lists where a mutable argument is required
+_ARGV_V4 = ("-v", "4")
+_ARGV_URAY = ("-u", "ray")
+_PROD_INCLUDES = ("lsst10-mysql.paf",
+                  "database/dc3a.paf",
+                  "platform/abecluster.paf")
+_IPSD_FILES = ("mops.paf",
+               "IPSD.paf",
+               "IPSD/01-sliceInfo_policy.paf",
+               "IPSD/02-symLink_policy-abe.paf",
+               "IPSD/03-imageInput0_policy.paf",
+               "IPSD/12-isr0_policy.paf",
+               "IPSD/14-calibAndBkgdExposureOutput_policy.paf")
+_ALL_INCLUDES = _PROD_INCLUDES + _IPSD_FILES
+
+
+class GoodRecorder(ProvenanceRecorder):
+    """
+    a test recorder whose assertion and counting hooks are caller-
+    supplied callables rather than a back-reference to one test case,
+    so a single instance (and its wired-up Log) can serve a whole class
+    of tests with the hooks rebound per test.
+    """
+
+    def __init__(self, assertion, increment, logger=None):
         ProvenanceRecorder.__init__(self, logger, True)
-        self.tester = testcase
+        self._assert = assertion
+        self._inc = increment
 
     def record(self, filename):
-        self.tester.assert_(len(filename) > 0, "empty filename found")
-        self._logger.log(Log.INFO, "recording "+filename)
-        self.tester.recorded += 1
+        self._assert(len(filename) > 0, "empty filename found")
+        # the tester logger is normally silenced; skip building the
+        # message when it would be filtered out anyway
+        if self._logger.sends(Log.INFO):
+            self._logger.log(Log.INFO, "recording "+filename)
+        self._inc()
 
 
 class ProvenanceSetupTestCase(unittest.TestCase):
 
+    # the file list collected by walking prodPolicyFile's include
+    # graph, built lazily once for the class by _populatedSetup()
+    _populated = None
+
+    @classmethod
+    def _populatedSetup(cls):
+        """
+        return a fresh ProvenanceSetup pre-populated from the include
+        graph of prodPolicyFile.  The expensive graph walk runs once
+        per class; later calls rebuild the setup from the cached file
+        list through the public API (the entries carry C++-backed
+        Policy objects, so the template cannot simply be deep-copied).
+        """
+        if cls._populated is None:
+            template = ProvenanceSetup()
+            template.addAllProductionPolicyFiles(prodPolicyFile, repos)
+            cls._populated = template.getFiles()
+            return template
+        setup = ProvenanceSetup()
+        setup.addProductionPolicyFiles(cls._populated)
+        return setup
+
+    @classmethod
+    def setUpClass(cls):
+        # constructed once for the class; setUp rebinds its hooks to
+        # the running test
+        cls.rec = GoodRecorder(lambda ok, msg=None: None,
+                               lambda: None, logger)
+
     def setUp(self):
         self.setup = ProvenanceSetup()
-        self.rec = GoodRecorder(self, logger)
         self.recorded = 0
+        self._countLock = threading.Lock()
+        self.rec._assert = self.assertTrue
+        self.rec._inc = self._increment
 
     def tearDown(self):
         del self.setup
-        del self.rec
+
+    def _increment(self):
+        # a recorder registered more than once runs on several of
+        # recordProduction's worker threads at a time, so the counter
+        # update must be atomic
+        with self._countLock:
+            self.recorded += 1
 
     def testProdRecorder(self):
         recs = self.setup.getRecorders()
-        self.assertEquals(len(recs), 0)
+        self.assertEqual(len(recs), 0)
         self.setup.addProductionRecorder(self.rec)
         recs = self.setup.getRecorders()
-        self.assertEquals(len(recs), 1)
+        self.assertEqual(len(recs), 1)
 
     def testAddFile(self):
         files = self.setup.getFiles()
-        self.assertEquals(len(files), 0)
+        self.assertEqual(len(files), 0)
 
         self.setup.addProductionPolicyFile("goober.paf")
         files = self.setup.getFiles()
-        self.assertEquals(len(files), 1)
-        self.assertEquals(files[0], "goober.paf")
+        self.assertEqual(len(files), 1)
+        self.assertEqual(files[0], "goober.paf")
 
         files[0] = "hank.paf"
         files = self.setup.getFiles()
-        self.assertEquals(len(files), 1)
-        self.assertEquals(files[0], "goober.paf")
+        self.assertEqual(len(files), 1)
+        self.assertEqual(files[0], "goober.paf")
 
         self.setup.addProductionPolicyFile("hank.paf")
         files = self.setup.getFiles()
-        self.assertEquals(len(files), 2)
-        self.assertEquals(files[0], "goober.paf")
-        self.assertEquals(files[1], "hank.paf")
+        self.assertEqual(len(files), 2)
+        self.assertEqual(files[0], "goober.paf")
+        self.assertEqual(files[1], "hank.paf")
 
     def testAddAllFiles(self):
         # see FindFilesTestCase for test of underlying function
-        self.assertEquals(len(self.setup.getFiles()), 0)
-        self.setup.addAllProductionPolicyFiles(prodPolicyFile, repos)
+        self.assertEqual(len(self.setup.getFiles()), 0)
+        self.setup = self._populatedSetup()
         files = self.setup.getFiles()
-        self.assertEquals(len(files), 4)
+        self.assertEqual(len(files), 4)
 
-        fileNameList = "lsst10-mysql.paf database/dc3a.paf platform/abecluster.paf".split()
-        find = [prodPolicyFile] + [os.path.join(repos, f) for f in fileNameList]
-        for file in find:
-            self.assert_(file in files, "Failed to file file: "+file)
+        find = [prodPolicyFile] + [os.path.join(repos, f)
+                                   for f in _PROD_INCLUDES]
+        missing = set(find) - set(files)
+        self.assertFalse(missing, "Failed to find files: %s" % sorted(missing))
 
         self.setup.addProductionRecorder(self.rec)
-        self.assertEquals(self.recorded, 0)
+        self.assertEqual(self.recorded, 0)
         self.setup.recordProduction()
-        self.assertEquals(self.recorded, 4)
+        self.assertEqual(self.recorded, 4)
 
     def testRecord(self):
         self.setup.addProductionPolicyFile("hank.paf")
         self.setup.addProductionRecorder(self.rec)
-        self.assertEquals(len(self.setup.getRecorders()), 1)
+        self.assertEqual(len(self.setup.getRecorders()), 1)
 
-        self.assertEquals(self.recorded, 0)
+        self.assertEqual(self.recorded, 0)
         self.setup.recordProduction()
-        self.assertEquals(self.recorded, 1)
+        self.assertEqual(self.recorded, 1)
 
         self.setup.addProductionRecorder(self.rec)
-        self.assertEquals(len(self.setup.getRecorders()), 2)
+        self.assertEqual(len(self.setup.getRecorders()), 2)
         self.setup.recordProduction()
-        self.assertEquals(self.recorded, 3)
+        self.assertEqual(self.recorded, 3)
 
     def testAddCmd(self):
-        self.assertEquals(len(self.setup.getCmds()), 0)
-        self.assertEquals(len(self.setup.getCmdPaths()), 0)
+        self.assertEqual(len(self.setup.getCmds()), 0)
+        self.assertEqual(len(self.setup.getCmdPaths()), 0)
 
-        self.setup.addWorkflowRecordCmd("recProv.py", "-v 4".split())
+        self.setup.addWorkflowRecordCmd("recProv.py", list(_ARGV_V4))
         cmds = self.setup.getCmds()
         paths = self.setup.getCmdPaths()
-        self.assertEquals(len(cmds), 1)
-        self.assertEquals(len(paths), 1)
-        self.assert_(isinstance(cmds[0], list), "command list not a tuple")
-        self.assert_(paths[0] is None, "found path when one not given")
-        self.assertEquals(cmds[0][0], "recProv.py")
-        self.assertEquals(cmds[0][1], "-v")
-        self.assertEquals(cmds[0][2], "4")
-
-        self.setup.addWorkflowRecordCmd("dbingest.py", "-u ray".split(),
+        self.assertEqual(len(cmds), 1)
+        self.assertEqual(len(paths), 1)
+        self.assertTrue(isinstance(cmds[0], list), "command list not a tuple")
+        self.assertTrue(paths[0] is None, "found path when one not given")
+        self.assertEqual(cmds[0][0], "recProv.py")
+        self.assertEqual(cmds[0][1], "-v")
+        self.assertEqual(cmds[0][2], "4")
+
+        self.setup.addWorkflowRecordCmd("dbingest.py", list(_ARGV_URAY),
                                         "/usr/local/bin/dbingest.py")
         cmds = self.setup.getCmds()
         paths = self.setup.getCmdPaths()
-        print("=======================================")
-        print(cmds)
-        print(paths)
-        print("=======================================")
-        self.assertEquals(len(cmds), 2)
-        self.assertEquals(len(paths), 2)
-        self.assertEquals(cmds[0][0], "recProv.py")
-        self.assertEquals(cmds[0][1], "-v")
-        self.assertEquals(cmds[0][2], "4")
-        self.assertEquals(cmds[1][0], "dbingest.py")
-        self.assertEquals(cmds[1][1], "-u")
-        self.assertEquals(cmds[1][2], "ray")
-        self.assertEquals(paths[1], "/usr/local/bin/dbingest.py")
+        self.assertEqual(len(cmds), 2)
+        self.assertEqual(len(paths), 2)
+        self.assertEqual(cmds[0][0], "recProv.py")
+        self.assertEqual(cmds[0][1], "-v")
+        self.assertEqual(cmds[0][2], "4")
+        self.assertEqual(cmds[1][0], "dbingest.py")
+        self.assertEqual(cmds[1][1], "-u")
+        self.assertEqual(cmds[1][2], "ray")
+        self.assertEqual(paths[1], "/usr/local/bin/dbingest.py")
 
 
 class FindFilesTestCase(unittest.TestCase):
 
-    def setUp(self):
-        pass
-
-    def tearDown(self):
-        pass
+    # no per-test fixture: the functions under test are static and the
+    # policy repository is immutable, so everything they need (logger,
+    # repos, prodPolicyFile) lives at module scope and is set up once.
+    # Repeated parses of the same .paf files are served from the
+    # provenance module's policy cache.
 
     def testExtractProdFiles(self):
         files = set(ProvenanceSetup.extractIncludedFilenames(prodPolicyFile,
                                                              repos,
                                                              pipefile="workflow.pipeline.definition"))
 
-        find = "lsst10-mysql.paf database/dc3a.paf platform/abecluster.paf".split()
-        self.assertEquals(len(files), len(find))
+        find = _PROD_INCLUDES
+        self.assertEqual(len(files), len(find))
 
-        for file in find:
-            self.assert_(file in files, "Failed to file file: "+file)
+        missing = set(find) - files
+        self.assertFalse(missing, "Failed to find files: %s" % sorted(missing))
 
     def testExtractProdFiles2(self):
         files = set(ProvenanceSetup.extractIncludedFilenames(prodPolicyFile, repos))
 
-        find = [
-            "lsst10-mysql.paf",
-            "database/dc3a.paf",
-            "platform/abecluster.paf",
-            "mops.paf",
-            "IPSD.paf",
-            "IPSD/01-sliceInfo_policy.paf",
-            "IPSD/02-symLink_policy-abe.paf",
-            "IPSD/03-imageInput0_policy.paf",
-            "IPSD/12-isr0_policy.paf",
-            "IPSD/14-calibAndBkgdExposureOutput_policy.paf",
-        ]
-        self.assertEquals(len(files), len(find))
-
-        for file in find:
-            self.assert_(file in files, "Failed to file file: "+file)
+        find = _ALL_INCLUDES
+        self.assertEqual(len(files), len(find))
+
+        missing = set(find) - files
+        self.assertFalse(missing, "Failed to find files: %s" % sorted(missing))
 
     def testExtractPipeFiles(self):
         files = set(ProvenanceSetup.extractPipelineFilenames("IPSD", prodPolicyFile, repos))
-        find = [
-            "mops.paf",
-            "IPSD.paf",
-            "IPSD/01-sliceInfo_policy.paf",
-            "IPSD/02-symLink_policy-abe.paf",
-            "IPSD/03-imageInput0_policy.paf",
-            "IPSD/12-isr0_policy.paf",
-            "IPSD/14-calibAndBkgdExposureOutput_policy.paf",
-        ]
-        self.assertEquals(len(files), len(find))
+        find = _IPSD_FILES
+        self.assertEqual(len(files), len(find))
 
-        for file in find:
-            self.assert_(file in files, "Failed to file file: "+file)
+        missing = set(find) - files
+        self.assertFalse(missing, "Failed to find files: %s" % sorted(missing))
 
 
 class MemoryTester(lsst.utils.tests.MemoryTestCase):
     pass
 
 
-def setup_module(module):
-    lsst.utils.tests.init()
-
-
 if __name__ == "__main__":
     lsst.utils.tests.init()
     unittest.main()